@@ -1,90 +1,238 @@
+import atexit
+import functools
+import os
+import selectors
+import signal
 import subprocess
 import time
-import select
 import re
 
+def _kill_process_group(process, sig=signal.SIGKILL):
+    """Send sig to the process group led by process, i.e. GAP and its children."""
+    # Once the process is reaped its pid may belong to an unrelated group;
+    # until then, even as a zombie, it keeps the pid and its group id
+    if process.returncode is not None:
+        return
+    try:
+        # GAP runs in its own session, so its process group id is its pid
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def _wait_for_exit(process, timeout):
+    """
+    Wait for process to exit without reaping it, so its pid stays reserved.
+    
+    Args:
+        process: The Popen object to wait for
+        timeout: Seconds to wait at most
+        
+    Returns:
+        True if the process has exited, False if it is still running
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        try:
+            if os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT | os.WNOHANG):
+                return True
+        except ChildProcessError:
+            # Already reaped
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+
 class GAP:
-    def __init__(self, gap_executable="gap"):
+    # Unique marker used to detect the end of a command's output
+    _MARKER = "___PYTHON_GAP_MARKER___"
+    
+    # Sent after every command to print the marker on stdout and stderr
+    _MARKER_COMMANDS = f'Print("{_MARKER}\\n");\nError("{_MARKER}\\n");\n'.encode()
+    
+    # Printed once at startup to tell when GAP is ready for commands
+    _READY_MARKER = "__GAPWRAPPER_READY__"
+    
+    # ANSI escape codes stripped from GAP's output
+    _ANSI_RE = re.compile(r'\033\[[0-9;]*m')
+    
+    def __init__(self, gap_executable="gap", timeout=None):
         """
         Initialize a GAP session.
         
         Args:
             gap_executable: Path to the GAP executable (default: "gap")
+            timeout: Seconds to wait for output from GAP before raising
+                TimeoutError (default: None, wait indefinitely)
         """
+        self.timeout = timeout
+        self._closed = False
+        self._atexit_hook = None
+        
+        # Kill GAP instead of quitting gracefully, e.g. in test suites
+        self._fast_shutdown = os.environ.get("GAPWRAPPER_FAST_SHUTDOWN") == "1"
+        
         # Start GAP process
         self.process = subprocess.Popen(
             [gap_executable, "-b"],  # -b for no banner
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True,
-            bufsize=0  # Unbuffered
+            bufsize=0,  # Unbuffered
+            start_new_session=True  # Own process group, killed as a whole
         )
         
-        # Wait for GAP to start up and consume initial output
-        time.sleep(0.5)
-        self._clear_output()
+        # Reap the process at interpreter exit even if close() is never called
+        if self._fast_shutdown:
+            self._atexit_hook = functools.partial(_kill_process_group, self.process)
+            atexit.register(self._atexit_hook)
+        
+        # Talk to GAP through the raw file descriptors
+        self._stdin_fd = self.process.stdin.fileno()
+        self._stdout_fd = self.process.stdout.fileno()
+        self._stderr_fd = self.process.stderr.fileno()
+        
+        # Output read past the last marker, kept for the next command
+        self._pending = {self._stdout_fd: bytearray(), self._stderr_fd: bytearray()}
+        
+        # Wait on both output pipes at once so GAP never blocks on a full one
+        self._selector = selectors.DefaultSelector()
+        for fd in self._pending:
+            os.set_blocking(fd, False)
+            self._selector.register(fd, selectors.EVENT_READ)
+        os.set_blocking(self._stdin_fd, False)
+        
+        # Wait for GAP to start up and discard its initial output; startup
+        # time is not bounded by the command timeout
+        try:
+            self._write(f'Print("{self._READY_MARKER}\\n");\n'.encode())
+        except BrokenPipeError:
+            raise RuntimeError("GAP process has terminated unexpectedly.")
+        self._read_until(self._stdout_fd, self._READY_MARKER.encode(), timeout=None)
+        self._pending[self._stderr_fd].clear()
         
         # Disable breaking on errors
         self("BreakOnError := false;;")
         
-    def _clear_output(self):
-        """Clear any pending output."""
+    def _fill(self, timeout):
+        """
+        Read whatever GAP has written to its stdout and stderr.
+        
+        Args:
+            timeout: Seconds to wait for output, or None to wait indefinitely
+            
+        Returns:
+            False if nothing arrived within the timeout, True otherwise
+        """
+        events = self._selector.select(timeout)
+        for key, _ in events:
+            if key.fd == self._stdin_fd:
+                continue
+            chunk = os.read(key.fd, 65536)
+            if not chunk:
+                raise RuntimeError("GAP process has terminated unexpectedly.")
+            self._pending[key.fd] += chunk
+        return bool(events)
+    
+    def _wait(self, timeout):
+        """
+        Wait for GAP's output, giving up on the session after the timeout.
+        
+        Args:
+            timeout: Seconds to wait, or None to wait indefinitely
+        """
+        if not self._fill(timeout):
+            # The command keeps running in GAP and its output would be
+            # returned by later calls, so this session is unusable now
+            self._shutdown(graceful=False)
+            raise TimeoutError(f"GAP did not respond within {timeout} seconds.")
+    
+    def _write(self, data):
+        """Write all of data to GAP's stdin, reading its output meanwhile."""
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self._stdin_fd, view):]
+            except BlockingIOError:
+                # GAP stops reading while its output pipes are full, so
+                # drain them until stdin has room again
+                self._selector.register(self._stdin_fd, selectors.EVENT_WRITE)
+                try:
+                    self._wait(self.timeout)
+                finally:
+                    if not self._closed:
+                        self._selector.unregister(self._stdin_fd)
+    
+    def _read_until(self, fd, marker, timeout):
+        """
+        Read from GAP until a line containing the marker arrives.
+        
+        Args:
+            fd: File descriptor of GAP's stdout or stderr
+            marker: Marker bytes to wait for
+            timeout: Seconds to wait for each chunk, or None to wait indefinitely
+            
+        Returns:
+            The decoded output preceding the marker line
+        """
+        buffer = self._pending[fd]
         while True:
-            ready, _, _ = select.select([self.process.stdout], [], [], 0.1)
-            if not ready:
-                break
-            self.process.stdout.readline()
+            index = buffer.find(marker)
+            if index != -1:
+                end = buffer.find(b'\n', index)
+                if end != -1:
+                    break
+            self._wait(timeout)
+        
+        start = buffer.rfind(b'\n', 0, index) + 1
+        output = bytes(buffer[:start])
+        del buffer[:end + 1]
+        return output.decode(errors='replace')
     
     def __call__(self, command):
         """
         Execute a GAP command and return the result.
         
         Args:
-            command: GAP command string
+            command: GAP command as a string or as UTF-8 encoded bytes
             
         Returns:
             The output from GAP
         """
+        if self._closed:
+            raise RuntimeError("GAP session is closed.")
+        
+        if isinstance(command, str):
+            command = command.encode()
+        
         # Ensure command ends with semicolon
-        if not command.strip().endswith(';'):
-            command = command.strip() + ';'
+        if not command.strip().endswith(b';'):
+            command = command.strip() + b';'
         
-        # Use a unique marker to detect end of output
-        marker = "___PYTHON_GAP_MARKER___"
+        marker = self._MARKER.encode()
         
         try:
           # Send command followed by a Print statement with our marker
-          self.process.stdin.write(command + '\n')
-          self.process.stdin.write(f'Print("{marker}\\n");\n')
-          self.process.stdin.write(f'Error("{marker}\\n");\n')
-          
-          self.process.stdin.flush()
+          self._write(command + b'\n' + self._MARKER_COMMANDS)
         except BrokenPipeError:
           raise RuntimeError("GAP process has terminated unexpectedly.")
         
         # Read output until we see our marker
         output_lines = []
-        while True:
-            output_line = self.process.stdout.readline()
-            if marker in output_line:
-                break
-            if output_line:
-                # Remove ANSI escape codes using regex
-                output_line = re.sub(r'\033\[[0-9;]*m', '', output_line)
-                output_line = output_line.replace('gap> ', '')
-                output_lines.append(output_line.rstrip())
+        for output_line in self._read_until(self._stdout_fd, marker, self.timeout).splitlines():
+            # Remove ANSI escape codes using regex
+            output_line = self._ANSI_RE.sub('', output_line)
+            output_line = output_line.replace('gap> ', '')
+            output_lines.append(output_line.rstrip())
         
         # Read any error output
         error_output = []
-        while True:
-            err_line = self.process.stderr.readline()
-            if marker in err_line:
-                break
-            if err_line:
-                # Remove ANSI escape codes using regex
-                err_line = re.sub(r'\033\[[0-9;]*m', '', err_line)
-                error_output.append(err_line.rstrip())
+        for err_line in self._read_until(self._stderr_fd, marker, self.timeout).splitlines():
+            # Remove ANSI escape codes using regex
+            err_line = self._ANSI_RE.sub('', err_line)
+            error_output.append(err_line.rstrip())
         
         # Join and clean up the output
         result = '\n'.join(output_lines).strip()
@@ -104,14 +252,37 @@ class GAP:
     
     def close(self):
         """Close the GAP session."""
+        self._shutdown(graceful=not self._fast_shutdown)
+    
+    def _shutdown(self, graceful):
+        """
+        Stop the GAP process and release its resources.
+        
+        Args:
+            graceful: Ask GAP to quit and send SIGTERM before killing it
+        """
+        if self._closed:
+            return
+        self._closed = True
+        
+        if self._atexit_hook:
+            atexit.unregister(self._atexit_hook)
+            self._atexit_hook = None
+        
         if self.process:
-            try:
-                self.process.stdin.write('quit;\n')
-                self.process.stdin.flush()
-            except:
-                pass
-            self.process.terminate()
+            if graceful:
+                try:
+                    os.write(self._stdin_fd, b'quit;\n')
+                except:
+                    pass
+                # Signal the whole group before GAP is reaped, while its
+                # pid still identifies the group
+                _kill_process_group(self.process, signal.SIGTERM)
+                _wait_for_exit(self.process, timeout=2)
+            # Kill whatever is left of GAP's process group, then reap GAP
+            _kill_process_group(self.process)
             self.process.wait(timeout=2)
+            self._selector.close()
     
     def __enter__(self):
         """Support context manager."""
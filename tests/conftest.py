@@ -0,0 +1,111 @@
+"""Shared fixtures for the GAP wrapper tests."""
+
+import os
+import re
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from gapwrapper import GAP
+
+# Tests don't need GAP to shut down gracefully; kill it instead.
+os.environ.setdefault("GAPWRAPPER_FAST_SHUTDOWN", "1")
+
+# Global variables the tests bind; they are unbound again after each test.
+TEST_VARIABLES = ("x", "y", "G")
+
+# Print/Error statements answered by the mocked GAP process.
+MARKER_STATEMENT_RE = re.compile(r'(Print|Error)\("(.*)"\);')
+
+
+def _answer_markers(stdin, stdout_fd, stderr_fd, received):
+    """Record the lines sent to a mocked GAP and answer its Print/Error statements."""
+    for line in stdin:
+        line = line.decode()
+        received.append(line)
+        match = MARKER_STATEMENT_RE.fullmatch(line.strip())
+        if match:
+            kind, text = match.groups()
+            text = text.replace("\\n", "\n")
+            if kind == "Print":
+                os.write(stdout_fd, text.encode())
+            else:
+                os.write(stderr_fd, f"Error, {text}".encode())
+
+
+@pytest.fixture(scope="session")
+def _gap_pool():
+    """Start a single GAP process shared by all tests of the session.
+
+    In fast shutdown mode the process is killed by the atexit hook
+    registered in GAP.__init__; otherwise it is closed here.
+    """
+    gap = GAP()
+    yield gap
+    if gap._atexit_hook is None:
+        gap.close()
+
+
+@pytest.fixture
+def gap(_gap_pool):
+    """Provide the shared GAP instance and reset its state afterwards."""
+    yield _gap_pool
+    _gap_pool(" ".join(f"Unbind({name});" for name in TEST_VARIABLES))
+
+
+@pytest.fixture
+def graceful_shutdown(monkeypatch):
+    """Use the default close() path, which quits GAP before killing it."""
+    monkeypatch.delenv("GAPWRAPPER_FAST_SHUTDOWN", raising=False)
+
+
+@pytest.fixture
+def fresh_gap():
+    """Provide a GAP instance of its own, for tests that need a new process."""
+    gap = GAP()
+    yield gap
+    gap.close()
+
+
+@pytest.fixture
+def mock_gap():
+    """Provide a GAP instance whose subprocess is replaced by plain pipes.
+
+    A thread answers the marker statements the wrapper sends, so no GAP is
+    needed; every line sent is recorded in mock_gap.process.received.
+    """
+    stdin_read, stdin_write = os.pipe()
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+
+    with (
+        patch("gapwrapper.main.subprocess.Popen") as popen,
+        patch("gapwrapper.main._kill_process_group"),
+        patch("gapwrapper.main._wait_for_exit", return_value=True),
+    ):
+        process = popen.return_value
+        process.stdin = open(stdin_write, "wb", buffering=0)
+        process.stdout = open(stdout_read, "rb", buffering=0)
+        process.stderr = open(stderr_read, "rb", buffering=0)
+        process.poll.return_value = None
+        process.received = []
+
+        gap_stdin = open(stdin_read, "rb")
+        responder = threading.Thread(
+            target=_answer_markers,
+            args=(gap_stdin, stdout_write, stderr_write, process.received),
+            daemon=True,
+        )
+        responder.start()
+
+        gap = GAP()
+        yield gap
+        gap.close()
+
+    process.stdin.close()
+    responder.join()
+    for f in (gap_stdin, process.stdout, process.stderr):
+        f.close()
+    os.close(stdout_write)
+    os.close(stderr_write)
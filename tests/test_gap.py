@@ -4,81 +4,114 @@ These tests require GAP (Groups, Algorithms, Programming) to be installed
 and available in the system PATH.
 """
 
+import atexit
+import os
+import signal
+import subprocess
+import time
+
 import pytest
 from unittest.mock import Mock, patch
 
+from gapwrapper import GAP
+from gapwrapper.main import _kill_process_group
 
-class TestGAPInitialization:
-    """Tests for GAP class initialization."""
 
-    def test_init_creates_process(self):
-        """Test that initialization creates a GAP process."""
-        from gapwrapper import GAP
-        gap = GAP()
+def _wait_until_dead(pid, timeout=5.0):
+    """Wait until pid has exited; it may linger as a zombie of its new parent."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
         try:
-            assert gap.process is not None
-            assert gap.process.poll() is None  # Process is running
-        finally:
-            gap.close()
+            with open(f"/proc/{pid}/stat") as f:
+                if f.read().rsplit(")", 1)[1].split()[0] == "Z":
+                    return True
+        except FileNotFoundError:
+            return True
+        time.sleep(0.05)
+    return False
 
-    def test_init_with_default_executable(self):
-        """Test initialization with default executable."""
-        from gapwrapper import GAP
-        gap = GAP()
-        try:
-            # Should be able to execute a simple command
-            result = gap("1+1;")
-            assert "2" in result
-        finally:
-            gap.close()
 
+class TestGAPModuleExports:
+    """Tests for module exports."""
 
-class TestGAPCommandExecution:
-    """Tests for GAP command execution."""
+    def test_gap_exported_from_package(self):
+        """Test that GAP class is exported from gapwrapper package."""
+        assert GAP is not None
 
-    @pytest.fixture
-    def gap(self):
-        """Create a GAP instance for testing."""
-        from gapwrapper import GAP
-        gap = GAP()
-        yield gap
-        gap.close()
+    def test_all_contains_gap(self):
+        """Test that __all__ contains 'GAP'."""
+        import gapwrapper
+        assert 'GAP' in gapwrapper.__all__
 
-    def test_simple_arithmetic(self, gap):
-        """Test simple arithmetic operations."""
-        result = gap("1 + 1;")
-        assert "2" in result
+    def test_gap_class_has_expected_methods(self):
+        """Test that GAP class has expected methods."""
+        expected = {'__call__', '__rshift__', '__enter__', '__exit__', 'close'}
+        assert expected - set(dir(GAP)) == set()
 
-    def test_multiplication(self, gap):
-        """Test multiplication."""
-        result = gap("6 * 7;")
-        assert "42" in result
 
-    def test_factorial(self, gap):
-        """Test factorial function."""
-        result = gap("Factorial(5);")
-        assert "120" in result
+class TestGAPCommandFormatting:
+    """Tests for how commands are sent to GAP, using a mocked process."""
 
-    def test_adds_semicolon_if_missing(self, gap):
+    def test_adds_semicolon_if_missing(self, mock_gap):
         """Test that __call__ adds semicolon if command doesn't end with one."""
-        result = gap("2 + 3")
-        assert "5" in result
+        mock_gap("2 + 3")
+        assert "2 + 3;\n" in mock_gap.process.received
 
-    def test_preserves_existing_semicolon(self, gap):
+    def test_preserves_existing_semicolon(self, mock_gap):
         """Test that __call__ preserves existing semicolon."""
-        result = gap("4 + 4;")
-        assert "8" in result
+        mock_gap("4 + 4;")
+        assert "4 + 4;\n" in mock_gap.process.received
+
+
+class TestGAPInitialization:
+    """Tests for GAP class initialization."""
+
+    def test_init_creates_process(self, fresh_gap):
+        """Test that initialization with the default executable creates a working GAP process."""
+        assert fresh_gap.process is not None
+        assert fresh_gap.process.poll() is None  # Process is running
+        # Should be able to execute a simple command
+        assert "2" in fresh_gap("1+1;")
+
+    def test_init_starts_own_process_group(self, gap):
+        """Test that GAP leads its own process group so close() can kill it whole."""
+        assert os.getpgid(gap.process.pid) == gap.process.pid
+
+
+class TestGAPCommandExecution:
+    """Tests for GAP command execution."""
+
+    @pytest.mark.parametrize("command,expected", [
+        ("1 + 1;", "2"),
+        ("6 * 7;", "42"),
+        ("Factorial(5);", "120"),
+        ("Sum([1,2,3,4,5]);", "15"),
+        ("1 < 2;", "true"),
+        ("2 < 1;", "false"),
+    ])
+    def test_arithmetic(self, gap, command, expected):
+        """Test arithmetic, list sum and boolean results."""
+        assert expected in gap(command).lower()
+
+    def test_accepts_bytes_command(self, gap):
+        """Test that __call__ accepts an already encoded command."""
+        result = gap(b"3 * 3;")
+        assert "9" in result
 
     def test_multiline_output(self, gap):
         """Test commands that produce multiline output."""
         result = gap("Elements(SymmetricGroup(3));")
         # Should contain permutation elements
-        assert "(" in result or "[" in result
+        assert any(ch in result for ch in "([")
+
+    def test_large_output(self, gap):
+        """Test that output larger than the pipe buffer is read completely."""
+        result = gap("Elements(SymmetricGroup(8));")
+        assert result.count("(") >= 40320
 
     def test_define_variable(self, gap):
         """Test defining and using a variable."""
-        gap("x := 10;")
-        result = gap("x * 2;")
+        result = gap("x := 10;; x * 2;")
         assert "20" in result
 
     def test_define_group(self, gap):
@@ -88,8 +121,7 @@ class TestGAPCommandExecution:
 
     def test_group_size(self, gap):
         """Test computing group size."""
-        gap("G := SymmetricGroup(4);")
-        result = gap("Size(G);")
+        result = gap("G := SymmetricGroup(4);; Size(G);")
         assert "24" in result
 
     def test_list_operations(self, gap):
@@ -97,56 +129,32 @@ class TestGAPCommandExecution:
         result = gap("[1,2,3,4,5];")
         assert "1" in result and "5" in result
 
-    def test_list_sum(self, gap):
-        """Test sum of a list."""
-        result = gap("Sum([1,2,3,4,5]);")
-        assert "15" in result
-
     def test_string_output(self, gap):
         """Test string output."""
         result = gap('Print("Hello");')
         assert "Hello" in result
 
-    def test_boolean_true(self, gap):
-        """Test boolean true."""
-        result = gap("1 < 2;")
-        assert "true" in result.lower()
-
-    def test_boolean_false(self, gap):
-        """Test boolean false."""
-        result = gap("2 < 1;")
-        assert "false" in result.lower()
-
 
 class TestGAPOperators:
     """Tests for GAP operator overloading."""
 
-    @pytest.fixture
-    def gap(self):
-        """Create a GAP instance for testing."""
-        from gapwrapper import GAP
-        gap = GAP()
-        yield gap
-        gap.close()
-
     def test_rshift_operator(self, gap):
         """Test that >> operator works like __call__."""
         result = gap >> "3 + 5;"
         assert "8" in result
 
-    def test_rshift_chain(self, gap):
-        """Test chaining >> operators."""
-        gap >> "y := 100;"
-        result = gap >> "y / 4;"
+    def test_rshift_multi_statement(self, gap):
+        """Test >> with a multi-statement command."""
+        result = gap >> "y := 100;; y / 4;"
         assert "25" in result
 
 
+@pytest.mark.usefixtures("graceful_shutdown")
 class TestGAPContextManager:
     """Tests for GAP context manager functionality."""
 
     def test_context_manager_enter(self):
         """Test that __enter__ returns the GAP instance."""
-        from gapwrapper import GAP
         with GAP() as gap:
             assert gap is not None
             assert hasattr(gap, 'process')
@@ -154,52 +162,84 @@ class TestGAPContextManager:
 
     def test_context_manager_exit_closes(self):
         """Test that __exit__ closes the process."""
-        from gapwrapper import GAP
-        import time
-        
         with GAP() as gap:
             process = gap.process
         
         # After exiting context, process should be terminated
-        # Poll with timeout instead of fixed sleep
-        timeout = 5.0
-        start = time.time()
-        while process.poll() is None and (time.time() - start) < timeout:
-            time.sleep(0.1)
+        # Wait for the exit instead of polling
+        try:
+            process.wait(timeout=5.0)
+        except subprocess.TimeoutExpired:
+            pass
         assert process.poll() is not None
 
     def test_context_manager_usage(self):
         """Test using GAP within context manager."""
-        from gapwrapper import GAP
         with GAP() as gap:
             result = gap("10 * 10;")
             assert "100" in result
 
 
+@pytest.mark.usefixtures("graceful_shutdown")
 class TestGAPClose:
     """Tests for GAP close functionality."""
 
     def test_close_terminates_process(self):
         """Test that close() terminates the process."""
-        from gapwrapper import GAP
-        import time
-        
         gap = GAP()
         process = gap.process
         
         gap.close()
         
         # Process should be terminated
-        # Poll with timeout instead of fixed sleep
-        timeout = 5.0
-        start = time.time()
-        while process.poll() is None and (time.time() - start) < timeout:
-            time.sleep(0.1)
+        # Wait for the exit instead of polling
+        try:
+            process.wait(timeout=5.0)
+        except subprocess.TimeoutExpired:
+            pass
         assert process.poll() is not None
 
+    def test_close_kills_gap_ignoring_sigterm(self, mock_gap):
+        """Test that close() kills GAP's process group when GAP outlives quit; and SIGTERM."""
+        process = mock_gap.process
+        with (
+            patch("gapwrapper.main._kill_process_group") as kill_process_group,
+            patch("gapwrapper.main._wait_for_exit", return_value=False),
+        ):
+            mock_gap.close()
+        assert kill_process_group.call_args_list == [
+            ((process, signal.SIGTERM),),
+            ((process,),),
+        ]
+        process.wait.assert_called_once()
+
+    def test_close_kills_children_of_gap(self, tmp_path):
+        """Test that close() also kills processes GAP started and left running."""
+        pid_file = tmp_path / "child.pid"
+        gap = GAP()
+        gap(f'Exec("sleep 1000 < /dev/null > /dev/null 2>&1 & echo $! > {pid_file}");')
+        child = int(pid_file.read_text())
+        gap.close()
+        assert _wait_until_dead(child)
+
+    def test_close_unregisters_atexit_hook(self, monkeypatch):
+        """Test that closing a fast-shutdown session removes its atexit hook."""
+        monkeypatch.setenv("GAPWRAPPER_FAST_SHUTDOWN", "1")
+        gap = GAP()
+        hook = gap._atexit_hook
+        with patch("gapwrapper.main.atexit.unregister", wraps=atexit.unregister) as unregister:
+            gap.close()
+        unregister.assert_called_once_with(hook)
+
+    def test_kill_skips_reaped_process(self):
+        """Test that a reaped process's pid, which may be reused, is never signalled."""
+        process = Mock(pid=12345, returncode=0)
+        with patch("gapwrapper.main.os.killpg") as killpg:
+            _kill_process_group(process)
+        killpg.assert_not_called()
+
     def test_close_is_idempotent(self):
         """Test that close() can be called multiple times safely."""
-        from gapwrapper import GAP
         gap = GAP()
         
         # Should not raise any exception
@@ -211,14 +251,6 @@ class TestGAPClose:
 class TestGAPErrorHandling:
     """Tests for GAP error handling."""
 
-    @pytest.fixture
-    def gap(self):
-        """Create a GAP instance for testing."""
-        from gapwrapper import GAP
-        gap = GAP()
-        yield gap
-        gap.close()
-
     def test_undefined_variable_handling(self, gap):
         """Test handling of undefined variables."""
         result = gap("UndefinedVariable12345;")
@@ -240,41 +272,43 @@ class TestGAPErrorHandling:
         result = gap("1 + 1;")
         assert "2" in result
 
+    def test_large_error_output(self):
+        """Test that error output larger than the pipe buffer does not block GAP."""
+        # Each line fails on its own, filling stderr before the marker is printed
+        command = "\n".join(f'Error("flood {i} {"x" * 100}");' for i in range(2000))
+        with GAP(timeout=30) as gap:
+            result = gap(command)
+            assert result.count("flood") >= 2000
+            assert "2" in gap("1 + 1;")
 
-class TestGAPBrokenPipe:
-    """Tests for broken pipe handling."""
 
-    def test_broken_pipe_raises_runtime_error(self):
-        """Test that broken pipe raises RuntimeError."""
-        from gapwrapper import GAP
-        gap = GAP()
-        
-        # Close the process to simulate broken pipe
-        gap.process.terminate()
-        gap.process.wait()
-        
-        with pytest.raises(RuntimeError, match="GAP process has terminated"):
-            gap("1+1;")
+class TestGAPTimeout:
+    """Tests for the output timeout."""
 
+    def test_slow_command_raises_timeout_error(self):
+        """Test that a command exceeding the timeout raises TimeoutError."""
+        with GAP(timeout=0.5) as gap:
+            with pytest.raises(TimeoutError, match="GAP did not respond"):
+                gap("for i in [1..10^9] do od;")
 
-class TestGAPModuleExports:
-    """Tests for module exports."""
+    def test_call_after_timeout_raises_runtime_error(self):
+        """Test that a timed out session refuses further commands instead of returning stale output."""
+        with GAP(timeout=0.5) as gap:
+            with pytest.raises(TimeoutError):
+                gap("for i in [1..10^9] do od; 99;")
+            assert gap.process.poll() is not None
+            with pytest.raises(RuntimeError, match="GAP session is closed"):
+                gap("2+2;")
 
-    def test_gap_exported_from_package(self):
-        """Test that GAP class is exported from gapwrapper package."""
-        from gapwrapper import GAP
-        assert GAP is not None
 
-    def test_all_contains_gap(self):
-        """Test that __all__ contains 'GAP'."""
-        import gapwrapper
-        assert 'GAP' in gapwrapper.__all__
+class TestGAPBrokenPipe:
+    """Tests for broken pipe handling."""
 
-    def test_gap_class_has_expected_methods(self):
-        """Test that GAP class has expected methods."""
-        from gapwrapper import GAP
-        assert hasattr(GAP, '__call__')
-        assert hasattr(GAP, '__rshift__')
-        assert hasattr(GAP, '__enter__')
-        assert hasattr(GAP, '__exit__')
-        assert hasattr(GAP, 'close')
+    def test_broken_pipe_raises_runtime_error(self, fresh_gap):
+        """Test that broken pipe raises RuntimeError."""
+        # Kill the process to simulate broken pipe
+        fresh_gap.process.kill()
+        fresh_gap.process.wait(timeout=2)
+        
+        with pytest.raises(RuntimeError, match="GAP process has terminated"):
+            fresh_gap("1+1;")